@@ -29,33 +29,35 @@
 #
 # Requires: darktable (darktable-cli)
 # Requires: hugin-tools (tca_correct)
-# Requires: ImageMagick (convert)
 # Requires: gnuplot
 #
 
 import os
 import argparse
-import configparser
 import codecs
+import collections
+import contextlib
 import re
 import math
-import multiprocessing
+import mmap
 import numpy as np
 import subprocess
 import shutil
 import tarfile
 import tempfile
+import threading
 import concurrent.futures
 from subprocess import DEVNULL
-from scipy.optimize.minpack import leastsq
+from xml.sax.saxutils import escape
+from scipy.optimize import least_squares
 
 from pyexiv2.metadata import ImageMetadata
 
-from PyPDF2 import PdfFileMerger
+from PyPDF2 import PdfFileReader, PdfFileWriter
 
 # Sidecar for loading into hugin
 # Applies a neutral basecurve and enables sharpening
-DARKTABLE_DISTORTION_SIDECAR = '''<?xml version="1.0" encoding="UTF-8"?>
+DARKTABLE_DISTORTION_SIDECAR = b'''<?xml version="1.0" encoding="UTF-8"?>
 <x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="XMP Core 4.4.0-Exiv2">
  <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
   <rdf:Description rdf:about=""
@@ -128,7 +130,7 @@ DARKTABLE_DISTORTION_SIDECAR = '''<?xml version="1.0" encoding="UTF-8"?>
 #
 # Setting colorin and colorout to Linear Rec2020 RGB makes it basically a no-op
 # and passes through camera RGB values.
-DARKTABLE_TCA_SIDECAR = '''<?xml version="1.0" encoding="UTF-8"?>
+DARKTABLE_TCA_SIDECAR = b'''<?xml version="1.0" encoding="UTF-8"?>
 <x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="XMP Core 4.4.0-Exiv2">
  <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
   <rdf:Description rdf:about=""
@@ -218,7 +220,7 @@ DARKTABLE_TCA_SIDECAR = '''<?xml version="1.0" encoding="UTF-8"?>
 # * set colorin to camera color matrix
 # * set colorin working space to Linear Rec2020 RGB
 # * set colorout to Linear Rec2020 RGB
-DARKTABLE_VIGNETTING_SIDECAR = '''<?xml version="1.0" encoding="UTF-8"?>
+DARKTABLE_VIGNETTING_SIDECAR = b'''<?xml version="1.0" encoding="UTF-8"?>
 <x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="XMP Core 4.4.0-Exiv2">
  <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
   <rdf:Description rdf:about=""
@@ -301,26 +303,114 @@ DARKTABLE_VIGNETTING_SIDECAR = '''<?xml version="1.0" encoding="UTF-8"?>
 </x:xmpmeta>
 '''
 
+# Look up the external tools only once instead of searching PATH for every
+# file which is processed
+DARKTABLE_CLI = shutil.which("darktable-cli")
+TCA_CORRECT = shutil.which("tca_correct")
+GNUPLOT = shutil.which("gnuplot")
+XZ = shutil.which("xz")
+
+# darktable core options for the 16bit TIFF export used for distortion
+DARKTABLE_TIFF_OPTIONS = (
+    "--conf", "plugins/lighttable/export/iccintent=0", # perceptual
+    "--conf", "plugins/lighttable/export/iccprofile=sRGB",
+    "--conf", "plugins/lighttable/export/style=none",
+    "--conf", "plugins/imageio/format/tiff/bpp=16",
+    "--conf", "plugins/imageio/format/tiff/compress=5",
+)
+
+# darktable core options for the PPM exports used for TCA and vignetting
+DARKTABLE_PPM_OPTIONS = (
+    "--conf", "plugins/lighttable/export/iccprofile=image",
+    "--conf", "plugins/lighttable/export/style=none",
+)
+
+RAW_FILE_EXTENSIONS = frozenset([
+    ".3FR", ".ARI", ".ARW", ".BAY", ".CRW", ".CR2", ".CAP", ".DCS",
+    ".DCR", ".DNG", ".DRF", ".EIP", ".ERF", ".FFF", ".IIQ", ".K25",
+    ".KDC", ".MEF", ".MOS", ".MRW", ".NEF", ".NRW", ".OBM", ".ORF",
+    ".PEF", ".PTX", ".PXN", ".R3D", ".RAF", ".RAW", ".RWL", ".RW2",
+    ".RWZ", ".SR2", ".SRF", ".SRW", ".X3F", ".JPG", ".JPEG", ".TIF",
+    ".TIFF",
+])
+
+# Header of binary NetPGM (P5) and NetPPM (P6) files
+NETPBM_HEADER_RE = re.compile(
+    rb"(^(P[56])\s(?:\s*#.*[\r\n])*"
+    rb"(\d+)\s(?:\s*#.*[\r\n])*"
+    rb"(\d+)\s(?:\s*#.*[\r\n])*"
+    rb"(\d+)\s(?:\s*#.*[\r\n]\s)*)")
+
+# Correction parameters printed by tca_correct
+TCA_CORRECT_OUTPUT_RE = re.compile(
+    r"-r [.0]+:(?P<br>[-.0-9]+):[.0]+:(?P<vr>[-.0-9]+) "
+    r"-b [.0]+:(?P<bb>[-.0-9]+):[.0]+:(?P<vb>[-.0-9]+)")
+
+# Lines of the small ini style files written by this script
+CONFIG_SECTION_RE = re.compile(r"\[(?P<section>.+)\]")
+CONFIG_OPTION_RE = re.compile(r"(?P<option>.*?)\s*[=:]\s*(?P<value>.*)")
+
+# Distortion options in lenses.conf, e.g. 'distortion(24.0mm)'
+DISTORTION_OPTION_RE = re.compile(r"distortion\((?P<focal_length>[0-9.]+)mm\)")
+
+# EXIF tags holding the lens model in the order they are looked up. The flag
+# tells if the human readable value of the tag should be used.
+LENS_MODEL_TAGS = [
+    ('Exif.Photo.LensModel', False),
+    ('Exif.NikonLd3.LensIDNumber', True),
+    ('Exif.Panasonic.LensType', False),
+    ('Exif.Sony1.LensID', True),
+    ('Exif.Minolta.LensID', True),
+    ('Exif.OlympusEq.LensType', True),
+]
+
+# Calibration entries written to lensfun.xml
+LENSFUN_DISTORTION_POLY3_FORMAT = (
+    '            '
+    '<distortion model="poly3" focal="%s" k1="%s" />\n')
+LENSFUN_DISTORTION_PTLENS_FORMAT = (
+    '            '
+    '<distortion model="ptlens" focal="%s" a="%s" b="%s" c="%s" />\n')
+LENSFUN_TCA_COMPLEX_FORMAT = (
+    '            '
+    '<tca model="poly3" focal="%s" br="%s" vr="%s" bb="%s" vb="%s" />\n')
+LENSFUN_TCA_SIMPLE_FORMAT = (
+    '            '
+    '<tca model="poly3" focal="%s" vr="%s" vb="%s" />\n')
+LENSFUN_VIGNETTING_FORMAT = (
+    '            '
+    '<vignetting model="pa" focal="%s" aperture="%s" distance="%s" '
+    'k1="%s" k2="%s" k3="%s" />\n')
+
+# The number of parallel jobs can be limited with LENSCAL_JOBS. Returns None
+# if it isn't set and raises a ValueError if it isn't a number.
+def get_jobs_override():
+    max_workers = os.environ.get("LENSCAL_JOBS")
+    if not max_workers:
+        return None
+
+    try:
+        return max(1, int(max_workers))
+    except ValueError:
+        raise ValueError("Invalid LENSCAL_JOBS value '%s', it needs to be a number" % max_workers)
+
 def get_max_worker_count():
-    max_workers = int(multiprocessing.cpu_count() / 2)
+    max_workers = get_jobs_override()
+    if max_workers is not None:
+        return max_workers
 
-    if max_workers < 1:
-        return 1
+    # Only count the CPUs we are allowed to run on
+    try:
+        max_workers = len(os.sched_getaffinity(0))
+    except AttributeError:
+        max_workers = os.cpu_count() or 1
 
-    return max_workers
+    return max(1, max_workers)
 
 def is_raw_file(filename):
-    raw_file_extensions = [
-            ".3FR", ".ARI", ".ARW", ".BAY", ".CRW", ".CR2", ".CAP", ".DCS",
-            ".DCR", ".DNG", ".DRF", ".EIP", ".ERF", ".FFF", ".IIQ", ".K25",
-            ".KDC", ".MEF", ".MOS", ".MRW", ".NEF", ".NRW", ".OBM", ".ORF",
-            ".PEF", ".PTX", ".PXN", ".R3D", ".RAF", ".RAW", ".RWL", ".RW2",
-            ".RWZ", ".SR2", ".SRF", ".SRW", ".X3F", ".JPG", ".JPEG", ".TIF",
-            ".TIFF",
-        ]
     file_ext = os.path.splitext(filename)[1]
 
-    return file_ext.upper() in raw_file_extensions
+    return file_ext.upper() in RAW_FILE_EXTENSIONS
 
 def has_exif_tag(data, tag):
     return tag in data
@@ -334,29 +424,10 @@ def image_read_exif(filename):
     # This reads the metadata and closes the file
     data.read()
 
-    lens_model = None
-    tag = 'Exif.Photo.LensModel'
-    if has_exif_tag(data, tag):
-        lens_model = data[tag].value
-    else:
-        tag = 'Exif.NikonLd3.LensIDNumber'
-        if has_exif_tag(data, tag):
-            lens_model = data[tag].human_value
-
-        tag = 'Exif.Panasonic.LensType'
-        if has_exif_tag(data, tag):
-            lens_model = data[tag].value
-
-        tag = 'Exif.Sony1.LensID'
-        if has_exif_tag(data, tag):
-            lens_model = data[tag].human_value
-
-        tag = 'Exif.Minolta.LensID'
-        if has_exif_tag(data, tag):
-            lens_model = data[tag].human_value
-
-    if lens_model is None:
-       lens_model = 'Standard'
+    lens_model = next((data[tag].human_value if human_value else data[tag].value
+                       for tag, human_value in LENS_MODEL_TAGS
+                       if has_exif_tag(data, tag)),
+                      'Standard')
 
     tag = 'Exif.Photo.FocalLength'
     if has_exif_tag(data, tag):
@@ -376,146 +447,170 @@ def image_read_exif(filename):
              "focal_length" : focal_length,
              "aperture" : aperture }
 
+# Call function with each tuple of arguments in jobs in a process pool and
+# yield the results in order. The jobs are handed to the workers in chunks,
+# which saves dispatch overhead when there are many short jobs.
+def run_parallel(function, jobs):
+    if len(jobs) == 0:
+        return
+
+    max_workers = get_max_worker_count()
+    chunksize = max(1, len(jobs) // (4 * max_workers))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(function, *zip(*jobs), chunksize=chunksize)
+
+# Read the EXIF data of several files in parallel, returns a dict mapping the
+# filenames to their EXIF data
+def image_read_exif_batch(filenames):
+    jobs = [(filename,) for filename in filenames]
+
+    return dict(zip(filenames, run_parallel(image_read_exif, jobs)))
+
 def write_sidecar_file(sidecar_file, content):
     if not os.path.isfile(sidecar_file):
         try:
-            with open(sidecar_file, 'w') as f:
+            with open(sidecar_file, 'wb') as f:
                 f.write(content)
         except OSError:
             return False
 
     return True
 
+# darktable-cli locks the databases in its config directory, so instances
+# running in parallel can't share one. Every process and thread reuses its own
+# directory for all images it converts, so darktable doesn't have to set up a new
+# configuration for each of them. The directories are created below
+# dt_config_root, a temporary directory which the run_* steps remove again
+# once they are done, also if darktable-cli failed.
+def get_darktable_configdir(dt_config_root):
+    configdir = os.path.join(dt_config_root,
+                             "%d-%d" % (os.getpid(), threading.get_ident()))
+    os.makedirs(configdir, exist_ok=True)
+
+    return configdir
+
+def run_darktable_cli(input_file, sidecar_file, dt_config_root, output_file, cli_options, core_options):
+    if DARKTABLE_CLI is None:
+        print("Could not find darktable-cli")
+        return False
+
+    dt_config_dir = get_darktable_configdir(dt_config_root)
+    dt_log_path = os.path.join(dt_config_dir, "dt.log")
+
+    with open(dt_log_path, 'wb', buffering=65536) as dt_log_file:
+        cmd = [
+                DARKTABLE_CLI,
+                input_file,
+                sidecar_file,
+                output_file,
+                *cli_options,
+                "--core",
+                "--configdir", dt_config_dir,
+                *core_options,
+            ]
+
+        try:
+            subprocess.check_call(cmd, stdout=dt_log_file, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            with open(dt_log_path, 'rb') as fin:
+                print(fin.read().decode(errors='replace'))
+            raise
+        except OSError:
+            print("Could not find darktable-cli")
+            return False
+
+        # The log is only needed on failure, don't keep it in the page cache
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(dt_log_file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+    return True
+
 # convert raw file to 16bit tiff
-def convert_raw_for_distortion(input_file, sidecar_file, output_file=None):
+def convert_raw_for_distortion(input_file, sidecar_file, dt_config_root, output_file=None):
     if output_file is None:
         output_file = ("%s.tif" % os.path.splitext(input_file)[0])
 
     if not os.path.exists(output_file):
         print("Converting %s to %s ..." % (input_file, output_file), flush=True)
 
-        with tempfile.TemporaryDirectory(prefix="lenscal_") as dt_tmp_dir:
-            dt_log_path = os.path.join(dt_tmp_dir, "dt.log")
-
-            with open(dt_log_path, 'w') as dt_log_file:
-                cmd = [
-                        "darktable-cli",
-                        input_file,
-                        sidecar_file,
-                        output_file,
-                        "--core",
-                        "--configdir", dt_tmp_dir,
-                        "--conf", "plugins/lighttable/export/iccintent=0", # perceptual
-                        "--conf", "plugins/lighttable/export/iccprofile=sRGB",
-                        "--conf", "plugins/lighttable/export/style=none",
-                        "--conf", "plugins/imageio/format/tiff/bpp=16",
-                        "--conf", "plugins/imageio/format/tiff/compress=5"
-                    ]
-
-                try:
-                    subprocess.check_call(cmd, stdout=dt_log_file, stderr=subprocess.STDOUT)
-                except subprocess.CalledProcessError:
-                    with open(dt_log_path, 'r') as fin:
-                        print(fin.read())
-                    raise
-                except OSError:
-                    print("Could not find darktable-cli")
-                    return None
+        if not run_darktable_cli(input_file, sidecar_file, dt_config_root, output_file,
+                                 (), DARKTABLE_TIFF_OPTIONS):
+            return None
 
     return output_file
 
-def convert_raw_for_tca(input_file, sidecar_file, output_file=None):
+def convert_raw_for_tca(input_file, sidecar_file, dt_config_root, output_file=None):
     if output_file is None:
         output_file = ("%s.ppm" % os.path.splitext(input_file)[0])
 
     if not os.path.exists(output_file):
-        with tempfile.TemporaryDirectory(prefix="lenscal_") as dt_tmp_dir:
-            dt_log_path = os.path.join(dt_tmp_dir, "dt.log")
-
-            with open(dt_log_path, 'w') as dt_log_file:
-                cmd = [
-                        "darktable-cli",
-                        input_file,
-                        sidecar_file,
-                        output_file,
-                        "--core",
-                        "--configdir", dt_tmp_dir,
-                        "--conf", "plugins/lighttable/export/iccprofile=image",
-                        "--conf", "plugins/lighttable/export/style=none",
-                    ]
-
-                try:
-                    subprocess.check_call(cmd, stdout=dt_log_file, stderr=subprocess.STDOUT)
-                except subprocess.CalledProcessError:
-                    with open(dt_log_path, 'r') as fin:
-                        print(fin.read())
-                    raise
-                except OSError:
-                    print("Could not find darktable-cli")
+        run_darktable_cli(input_file, sidecar_file, dt_config_root, output_file,
+                          (), DARKTABLE_PPM_OPTIONS)
 
     return output_file
 
-def convert_raw_for_vignetting(input_file, sidecar_file, output_file=None):
+def convert_raw_for_vignetting(input_file, sidecar_file, dt_config_root, output_file=None):
     if output_file is None:
         output_file = ("%s.ppm" % os.path.splitext(input_file)[0])
 
     if not os.path.exists(output_file):
-        with tempfile.TemporaryDirectory(prefix="lenscal_") as dt_tmp_dir:
-            dt_log_path = os.path.join(dt_tmp_dir, "dt.log")
-
-            with open(dt_log_path, 'w') as dt_log_file:
-                cmd = [
-                        "darktable-cli",
-                        input_file,
-                        sidecar_file,
-                        output_file,
-                        "--width", "250",
-                        "--core",
-                        "--configdir", dt_tmp_dir,
-                        "--conf", "plugins/lighttable/export/iccprofile=image",
-                        "--conf", "plugins/lighttable/export/style=none",
-                    ]
-
-                try:
-                    subprocess.check_call(cmd, stdout=dt_log_file, stderr=subprocess.STDOUT)
-                except subprocess.CalledProcessError:
-                    with open(dt_log_path, 'r') as fin:
-                        print(fin.read())
-                    raise
-                except OSError:
-                    print("Could not find darktable-cli")
+        run_darktable_cli(input_file, sidecar_file, dt_config_root, output_file,
+                          ("--width", "250"), DARKTABLE_PPM_OPTIONS)
 
     return output_file
 
+# darktable-cli processes one image at a time, so run several instances in
+# parallel. The threads only wait for their darktable-cli process, so there is
+# no need for a Python worker process per conversion. files is a list of
+# (input_file, output_file) tuples.
+def convert_batch(files, sidecar_file, dt_config_root, converter):
+    # Find the files which have already been converted with one scan per
+    # output directory instead of checking every output file on its own.
+    existing_files = set()
+    for output_dir in {os.path.dirname(output_file) for input_file, output_file in files}:
+        if not os.path.isdir(output_dir or os.curdir):
+            continue
+
+        with os.scandir(output_dir or os.curdir) as it:
+            existing_files.update(os.path.join(output_dir, entry.name) for entry in it)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=get_max_worker_count()) as executor:
+        result_futures = {}
+
+        for input_file, output_file in files:
+            if output_file in existing_files:
+                continue
+
+            future = executor.submit(converter, input_file, sidecar_file, dt_config_root, output_file)
+            result_futures[output_file] = future
+
+        return [result_futures[output_file].result() if output_file in result_futures else output_file
+                for input_file, output_file in files]
+
 def convert_ppm_for_vignetting(input_file):
     output_file = ("%s.pgm" % os.path.splitext(input_file)[0])
 
-    # Convert the ppm file to a pgm (grayscale) file
+    # Convert the ppm file to a pgm (grayscale) file. The samples are weighted
+    # as they are (Rec. 601 luma), without any gamma conversion.
     if not os.path.exists(output_file):
-        cmd = [ "convert",
-                "-colorspace",
-                "RGB",
-                input_file,
-                "-set",
-                "colorspace",
-                "RGB",
-                output_file ]
-        try:
-            subprocess.check_call(cmd, stdout=DEVNULL, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-            raise
-        except OSError:
-            print("Could not find convert")
+        width, height, maxval, image_data = load_netpbm(input_file, b"P6")
+
+        gray = np.dot(image_data, np.array([0.299, 0.587, 0.114], dtype=np.float32))
+        gray = np.rint(gray).astype(image_data.dtype)
+
+        with open(output_file, 'wb') as f:
+            f.write(b"P5\n%d %d\n%d\n" % (width, height, maxval))
+            f.write(gray.tobytes())
 
     return output_file
 
 def plot_pdf(plot_file):
-    try:
-        gnuplot = shutil.which("gnuplot")
-    except shutil.Error:
+    if GNUPLOT is None:
+        print("Could not find gnuplot")
         return False
 
-    cmd = [ gnuplot, plot_file ]
+    cmd = [ GNUPLOT, plot_file ]
     try:
         subprocess.check_call(cmd, stdout=DEVNULL, stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError:
@@ -526,31 +621,53 @@ def plot_pdf(plot_file):
 
     return True
 
-def merge_final_pdf(final_pdf, pdf_dir):
-    pdf_merger = PdfFileMerger()
+# The exported directories are flat, so a single scan is enough to find the
+# files created by the calibration steps
+def list_files(directory, extension):
+    if not os.path.isdir(directory):
+        return []
 
-    pdf_files = []
+    with os.scandir(directory) as it:
+        return sorted(entry.path for entry in it
+                      if entry.is_file() and entry.name.endswith(extension))
 
-    for path, directories, files in os.walk(pdf_dir):
-        for filename in files:
-            if os.path.splitext(filename)[1] != '.pdf':
-                continue
-
-            pdf_files.append(filename)
+def merge_final_pdf(final_pdf, pdf_dir):
+    pdf_files = list_files(pdf_dir, '.pdf')
 
     if len(pdf_files) == 0:
         return
 
-    pdf_files.sort()
+    pdf_writer = PdfFileWriter()
+
+    # The pages are copied from the source files when the final pdf is
+    # written, so they have to stay open until then.
+    with contextlib.ExitStack() as stack:
+        for pdf in pdf_files:
+            pdf_reader = PdfFileReader(stack.enter_context(open(pdf, 'rb')))
 
-    for pdf in pdf_files:
-        pdf_merger.append(os.path.join(pdf_dir, pdf))
+            for page in range(pdf_reader.getNumPages()):
+                pdf_writer.addPage(pdf_reader.getPage(page))
 
-    pdf_merger.write(final_pdf)
-    pdf_merger.close()
+        with open(final_pdf, 'wb') as f:
+            pdf_writer.write(f)
+
+# Write a dict of sections with a dict of options each in the format
+# configparser uses, which is read back with parse_config_file().
+def write_config_file(filename, sections):
+    lines = []
+
+    for section, options in sections.items():
+        lines.append("[%s]\n" % section)
+        for option, value in options.items():
+            value = str(value).replace('\n', '\n\t')
+            lines.append("%s = %s\n" % (option.lower(), value))
+        lines.append("\n")
+
+    with open(filename, 'w') as f:
+        f.write(''.join(lines))
 
 def create_lenses_config(lenses_exif_group):
-    config = configparser.ConfigParser()
+    config = {}
     for lenses in lenses_exif_group:
         config[lenses] = {
                 'maker' : '[unknown]',
@@ -562,8 +679,7 @@ def create_lenses_config(lenses_exif_group):
         for exif_data in lenses_exif_group[lenses]:
             distortion = ("distortion(%.1fmm)" % exif_data['focal_length'])
             config[lenses][distortion] = '0.0, 0.0, 0.0'
-    with open('lenses.conf', 'w') as configfile:
-        config.write(configfile)
+    write_config_file('lenses.conf', config)
 
     print("A template has been created for distortion corrections as lenses.conf.")
     print("Please fill this file with proper information. The most important")
@@ -584,22 +700,75 @@ def create_lenses_config(lenses_exif_group):
 
     return
 
+# A minimal reader for the config files written by this script. It returns a
+# dict of sections with a dict of options each. Like configparser, option
+# names are lower case, a line indented deeper than the option before it
+# continues its value and the options of a DEFAULT section are used as
+# defaults for all other sections.
+def parse_config_file(filename):
+    sections = {}
+    section = None
+    option = None
+    option_indent = 0
+
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.strip() == '' or line.lstrip().startswith(('#', ';')):
+                continue
+
+            indent = len(line) - len(line.lstrip())
+            line = line.strip()
+
+            if option is not None and indent > option_indent:
+                section[option] += '\n' + line
+                continue
+
+            section_match = CONFIG_SECTION_RE.fullmatch(line)
+            if section_match is not None:
+                section = sections.setdefault(section_match.group('section'), {})
+                option = None
+                continue
+
+            option_match = CONFIG_OPTION_RE.fullmatch(line)
+            if option_match is None or section is None:
+                raise ValueError("Invalid line in '%s': %s" % (filename, line))
+
+            option = option_match.group('option').lower()
+            option_indent = indent
+            section[option] = option_match.group('value')
+
+    defaults = sections.pop('DEFAULT', {})
+
+    return {name: dict(defaults, **options) for name, options in sections.items()}
+
+# The distortion values in lenses.conf are either the 'a, b, c' coefficients
+# of the ptlens model or only 'k1' of the poly3 model. Return them as a tuple of
+# three strings where missing coefficients are None.
+def parse_distortion_coefficients(value):
+    coefficients = [coefficient.strip() for coefficient in value.split(',')]
+    coefficients = [None if coefficient in ('', 'None', 'none') else coefficient
+                    for coefficient in coefficients]
+    coefficients += [None] * (3 - len(coefficients))
+
+    return tuple(coefficients)
+
 def parse_lenses_config(filename):
-    config = configparser.ConfigParser()
-    config.read(filename)
+    config = parse_config_file(filename)
 
     lenses = {}
 
-    for section in config.sections():
+    for section in config:
         lenses[section] = {}
         lenses[section]['distortion'] = {}
         lenses[section]['tca'] = {}
-        lenses[section]['vignetting'] = {}
+        # vignetting data is stored by focal length, aperture and distance
+        lenses[section]['vignetting'] = collections.defaultdict(lambda: collections.defaultdict(dict))
 
         for key in config[section]:
-            if key.startswith('distortion'):
-                focal_length = key[11:len(key) - 3]
-                lenses[section]['distortion'][focal_length] = config[section][key]
+            distortion_match = DISTORTION_OPTION_RE.fullmatch(key)
+            if distortion_match is not None:
+                focal_length = distortion_match.group('focal_length')
+                lenses[section]['distortion'][focal_length] = parse_distortion_coefficients(config[section][key])
             else:
                 lenses[section][key] = config[section][key]
 
@@ -617,7 +786,11 @@ def tca_correct(input_file, original_file, exif_data, complex_tca=False):
         tca_complexity = 'v'
         if complex_tca:
             tca_complexity = 'bv'
-        cmd = [ "tca_correct", "-o", tca_complexity, input_file ]
+        if TCA_CORRECT is None:
+            print("Could not find tca_correct")
+            return None
+
+        cmd = [ TCA_CORRECT, "-o", tca_complexity, input_file ]
         try:
             output = subprocess.check_output(cmd, stderr=DEVNULL)
         except subprocess.CalledProcessError:
@@ -626,15 +799,14 @@ def tca_correct(input_file, original_file, exif_data, complex_tca=False):
             print("Could not find tca_correct")
             return None
 
-        tca_data_match = re.match(r"-r [.0]+:(?P<br>[-.0-9]+):[.0]+:(?P<vr>[-.0-9]+) -b [.0]+:(?P<bb>[-.0-9]+):[.0]+:(?P<vb>[-.0-9]+)",
-                            output.decode('ascii'))
+        tca_data_match = TCA_CORRECT_OUTPUT_RE.match(output.decode('ascii'))
         if tca_data_match is None:
             print("Could not find tca correction data")
             return None
 
         tca_data = tca_data_match.groupdict()
 
-        tca_config = configparser.ConfigParser()
+        tca_config = {}
         tca_config[exif_data['lens_model']] = {
                 'focal_length' : exif_data['focal_length'],
                 'complex_tca' : complex_tca,
@@ -644,8 +816,7 @@ def tca_correct(input_file, original_file, exif_data, complex_tca=False):
                 'bb' : tca_data['bb'],
                 'vb' : tca_data['vb'],
                 }
-        with open(output_file, "w") as tcafile:
-            tca_config.write(tcafile)
+        write_config_file(output_file, tca_config)
 
         if complex_tca:
             with codecs.open(gp_filename, "w", encoding="utf-8") as c:
@@ -664,24 +835,23 @@ def tca_correct(input_file, original_file, exif_data, complex_tca=False):
 
             plot_pdf(gp_filename)
 
-def load_pgm(filename):
+def load_netpbm(filename, magic):
     header = None
     width = None
     height = None
     maxval = None
 
+    # Map the file instead of reading it. The returned array is a view on the
+    # mapping and keeps it alive, so the pixel data is never copied.
     with open(filename, 'rb') as f:
-        buf = f.read()
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
     try:
-        header, width, height, maxval = re.search(
-            b"(^P5\s(?:\s*#.*[\r\n])*"
-            b"(\d+)\s(?:\s*#.*[\r\n])*"
-            b"(\d+)\s(?:\s*#.*[\r\n])*"
-            b"(\d+)\s(?:\s*#.*[\r\n]\s)*)", buf).groups()
+        header, file_magic, width, height, maxval = NETPBM_HEADER_RE.search(buf).groups()
     except AttributeError:
-        raise ValueError("Not a NetPGM file: '%s'" % filename)
+        raise ValueError("Not a NetPBM file: '%s'" % filename)
 
-    f.close()
+    if file_magic != magic:
+        raise ValueError("Not a NetPBM file: '%s'" % filename)
 
     width = int(width)
     height = int(height)
@@ -694,18 +864,40 @@ def load_pgm(filename):
     elif maxval == 4294967295:
         dt = np.dtype(np.float32)
     else:
-        raise ValueError("Not a NetPGM file: '%s'" % filename)
+        raise ValueError("Not a NetPBM file: '%s'" % filename)
     dt = dt.newbyteorder('B')
 
-    shape = np.frombuffer(buf,
-                          dtype = dt,
-                          count = width * height,
-                          offset = len(header))
+    # PPM (P6) files store three samples per pixel, PGM (P5) files one
+    if magic == b"P6":
+        shape = (height, width, 3)
+    else:
+        shape = (height, width)
+
+    data = np.frombuffer(buf,
+                         dtype = dt,
+                         count = math.prod(shape),
+                         offset = len(header))
+
+    return width, height, maxval, data.reshape(shape)
+
+def load_pgm(filename):
+    width, height, maxval, image_data = load_netpbm(filename, b"P5")
+
+    return width, height, image_data
+
+# The vignetting is modelled as A * (1 + k1 * r^2 + k2 * r^4 + k3 * r^6). powers
+# holds the columns r^0, r^2, r^4 and r^6 of the radii, so the polynomial is a
+# single matrix product and the powers are only computed once per fit.
+def vignetting_residuals(params, powers, intensities):
+    A, k1, k2, k3 = params
 
-    return width, height, shape.reshape((height, width))
+    return intensities - A * powers.dot((1, k1, k2, k3))
 
-def fit_function(radius, A, k1, k2, k3):
-    return A * (1 + k1 * radius**2 + k2 * radius**4 + k3 * radius**6)
+def vignetting_jacobian(params, powers, intensities):
+    A, k1, k2, k3 = params
+
+    # Partial derivatives of the residuals
+    return -np.column_stack((powers.dot((1, k1, k2, k3)), A * powers[:, 1:]))
 
 def calculate_vignetting(input_file, original_file, exif_data, distance):
     basename = os.path.splitext(input_file)[0]
@@ -729,30 +921,27 @@ def calculate_vignetting(input_file, original_file, exif_data, distance):
     maximal_radius = 1
 
     # Only remember pixel intensities which are in the given radius
-    radii, intensities = [], []
-    for y in range(image_data.shape[0]):
-        for x in range(image_data.shape[1]):
-            radius = math.hypot(x - width // 2, y - height // 2) / half_diagonal
-            if radius <= maximal_radius:
-                radii.append(radius)
-                intensities.append(image_data[y,x])
-
-    with open(all_points_filename, 'w') as f:
-        for radius, intensity in zip(radii, intensities):
-            f.write("%f %d\n" % (radius, intensity))
+    y, x = np.ogrid[0:height, 0:width]
+    radius = np.hypot(x - width // 2, y - height // 2).ravel() / half_diagonal
+    inside = np.flatnonzero(radius <= maximal_radius)
+    radii = radius[inside]
+    # 16bit samples are stored big endian, convert them to native floats once
+    # instead of in every following operation
+    intensities = image_data.ravel()[inside].astype(np.float32)
+
+    # The samples are only used for plotting
+    if GNUPLOT is not None:
+        np.savetxt(all_points_filename, np.column_stack((radii, intensities)), fmt="%f %d")
 
     number_of_bins = 16
-    bins = [[] for i in range(number_of_bins)]
-    for radius, intensity in zip(radii, intensities):
-        # The zeroth and the last bin are only half bins which means that their
-        # means are skewed.  But this is okay: For the zeroth, the curve is
-        # supposed to be horizontal anyway, and for the last, it underestimates
-        # the vignetting at the rim which is a good thing (too much of
-        # correction is bad).
-        bin_index = int(round(radius / maximal_radius * (number_of_bins - 1)))
-        bins[bin_index].append(intensity)
+    # The zeroth and the last bin are only half bins which means that their
+    # means are skewed.  But this is okay: For the zeroth, the curve is
+    # supposed to be horizontal anyway, and for the last, it underestimates
+    # the vignetting at the rim which is a good thing (too much of
+    # correction is bad).
+    bin_indices = np.rint(radii / maximal_radius * (number_of_bins - 1)).astype(np.intp)
+    intensities = [np.median(intensities[bin_indices == i]) for i in range(number_of_bins)]
     radii = [i / (number_of_bins - 1) * maximal_radius for i in range(number_of_bins)]
-    intensities = [np.median(bin) for bin in bins]
 
     with open(bins_filename, 'w') as f:
         for radius, intensity in zip(radii, intensities):
@@ -760,9 +949,13 @@ def calculate_vignetting(input_file, original_file, exif_data, distance):
 
     radii, intensities = np.array(radii), np.array(intensities)
 
-    A, k1, k2, k3 = leastsq(lambda p, x, y: y - fit_function(x, *p), [30000, -0.3, 0, 0], args=(radii, intensities))[0]
+    powers = radii[:, np.newaxis] ** np.array([0, 2, 4, 6])
 
-    vig_config = configparser.ConfigParser()
+    A, k1, k2, k3 = least_squares(vignetting_residuals, [30000, -0.3, 0, 0],
+                                  jac=vignetting_jacobian, method='trf', x_scale='jac',
+                                  args=(powers, intensities)).x
+
+    vig_config = {}
     vig_config[exif_data['lens_model']] = {
                 'focal_length' : exif_data['focal_length'],
                 'aperture' : exif_data['aperture'],
@@ -772,8 +965,7 @@ def calculate_vignetting(input_file, original_file, exif_data, distance):
                 'k2' : ('%.7f' % k2),
                 'k3' : ('%.7f' % k3),
                 }
-    with open(vig_filename, "w") as vigfile:
-        vig_config.write(vigfile)
+    write_config_file(vig_filename, vig_config)
 
     if distance == float("inf"):
         distance = "∞"
@@ -816,15 +1008,6 @@ def init():
           "2. tca        - Put chromatic abbrevation RAW files in here\n"
           "3. vignetting - Put RAW files to calculate vignetting in here\n")
 
-def create_distortion_correction(export_path, path, filename, sidecar_file):
-    input_file = os.path.join(path, filename)
-    output_file = os.path.join(path, "exported", ("%s.tif" % os.path.splitext(filename)[0]))
-
-    # Convert RAW files to TIF for hugin
-    output_file = convert_raw_for_distortion(input_file, sidecar_file, output_file)
-
-    return True
-
 def run_distortion():
     lenses_config_exists = os.path.isfile('lenses.conf')
     lenses_exif_group = {}
@@ -844,7 +1027,8 @@ def run_distortion():
         print("Failed to write sidecar_file: %s" % sidecar_file)
         return
 
-    # Parse EXIF data
+    # Collect the files to create TIFFs for hugin
+    convert_files = []
     for path, directories, files in os.walk('distortion'):
         for filename in files:
             if path != "distortion":
@@ -853,32 +1037,24 @@ def run_distortion():
                 continue
 
             input_file = os.path.join(path, filename)
+            output_file = os.path.join(export_path, ("%s.tif" % os.path.splitext(filename)[0]))
+            convert_files.append((input_file, output_file))
 
-            exif_data = image_read_exif(input_file)
-            if exif_data is not None:
-                if exif_data['lens_model'] not in lenses_exif_group:
-                    lenses_exif_group[exif_data['lens_model']] = []
-                lenses_exif_group[exif_data['lens_model']].append(exif_data)
-
-                # Add focal length to file name for easier identification
-                if exif_data['focal_length'] > 1.0:
-                    output_file = os.path.join(path, "exported", ("%s_%dmm.tif" % (os.path.splitext(filename)[0], exif_data['focal_length'])))
+    # Parse EXIF data
+    input_files = [input_file for input_file, output_file in convert_files]
+    exif_batch = image_read_exif_batch(input_files)
+    for input_file in input_files:
+        exif_data = exif_batch[input_file]
+        if exif_data is not None:
+            if exif_data['lens_model'] not in lenses_exif_group:
+                lenses_exif_group[exif_data['lens_model']] = []
+            lenses_exif_group[exif_data['lens_model']].append(exif_data)
 
     # Create TIFF for hugin
-    with concurrent.futures.ProcessPoolExecutor(max_workers=get_max_worker_count()) as executor:
-        result_futures = []
-
-        for path, directories, files in os.walk('distortion'):
-            for filename in files:
-                if path != "distortion":
-                    continue
-                if not is_raw_file(filename):
-                    continue
-                future = executor.submit(create_distortion_correction, export_path, path, filename, sidecar_file)
-                result_futures.append(future)
-
-        for f in concurrent.futures.as_completed(result_futures):
-            if f.result():
+    with tempfile.TemporaryDirectory(prefix="lenscal_") as dt_config_root:
+        for output_file in convert_batch(convert_files, sidecar_file, dt_config_root,
+                                         convert_raw_for_distortion):
+            if output_file is not None:
                 print("OK")
 
     if not lenses_config_exists:
@@ -889,18 +1065,21 @@ def run_distortion():
 
         create_lenses_config(sorted_lenses_exif_group)
 
-def create_tca_correction(export_path, path, filename, sidecar_file, complex_tca):
+def create_tca_correction(export_path, path, filename, sidecar_file, dt_config_root, complex_tca):
     # Convert RAW
     input_file = os.path.join(path, filename)
 
-    # Read EXIF data
-    exif_data = image_read_exif(input_file)
-
     # Convert RAW file to ppm
     output_file = os.path.join(path, "exported", ("%s.ppm" % os.path.splitext(filename)[0]))
+    tca_file = ("%s.tca" % os.path.splitext(output_file)[0])
+
+    # Read EXIF data, it is only needed if the tca file doesn't exist yet
+    exif_data = None
+    if not os.path.exists(tca_file):
+        exif_data = image_read_exif(input_file)
 
     print("Processing %s ... " % (input_file), flush=True)
-    output_file = convert_raw_for_tca(input_file, sidecar_file, output_file)
+    output_file = convert_raw_for_tca(input_file, sidecar_file, dt_config_root, output_file)
 
     tca_correct(output_file, input_file, exif_data, complex_tca)
 
@@ -920,9 +1099,8 @@ def run_tca(complex_tca):
         print("Failed to write sidecar_file: %s" % sidecar_file)
         return
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=get_max_worker_count()) as executor:
-        result_futures = []
-
+    with tempfile.TemporaryDirectory(prefix="lenscal_") as dt_config_root:
+        jobs = []
         for path, directories, files in os.walk('tca'):
             for filename in files:
                 if path != "tca":
@@ -930,29 +1108,33 @@ def run_tca(complex_tca):
                 if not is_raw_file(filename):
                     continue
 
-                future = executor.submit(create_tca_correction, export_path, path, filename, sidecar_file, complex_tca)
+                jobs.append((export_path, path, filename, sidecar_file, dt_config_root, complex_tca))
 
-        for f in concurrent.futures.as_completed(result_futures):
-            if f.result():
+        for result in run_parallel(create_tca_correction, jobs):
+            if result:
                 print("OK")
 
     if complex_tca:
         merge_final_pdf("tca.pdf", "tca/exported")
 
-def create_vignetting_correction(export_path, path, filename, sidecar_file, distance):
+def create_vignetting_correction(export_path, path, filename, sidecar_file, dt_config_root, distance):
     # Convert RAW files to NetPGM
     input_file = os.path.join(path, filename)
 
-    # Read EXIF data
-    exif_data = image_read_exif(input_file)
-
     # Convert the RAW file to ppm
-    output_file = os.path.join(export_path, ("%s.ppm" % os.path.splitext(filename)[0]))
-    preview_file = os.path.join(export_path, ("%s.jpg" % os.path.splitext(filename)[0]))
+    basename = os.path.splitext(filename)[0]
+    output_file = os.path.join(export_path, ("%s.ppm" % basename))
+    preview_file = os.path.join(export_path, ("%s.jpg" % basename))
+    vig_file = os.path.join(export_path, ("%s.vig" % basename))
+
+    # Read EXIF data, it is only needed if the vig file doesn't exist yet
+    exif_data = None
+    if not os.path.exists(vig_file):
+        exif_data = image_read_exif(input_file)
 
     print("Processing %s ... " % (input_file), flush=True)
 
-    output_file = convert_raw_for_vignetting(input_file, sidecar_file, output_file)
+    output_file = convert_raw_for_vignetting(input_file, sidecar_file, dt_config_root, output_file)
 
     # Create vignetting PGM files (grayscale)
     pgm_file = convert_ppm_for_vignetting(output_file)
@@ -961,7 +1143,7 @@ def create_vignetting_correction(export_path, path, filename, sidecar_file, dist
     calculate_vignetting(pgm_file, input_file, exif_data, distance)
 
     # Create preview jpg
-    convert_raw_for_vignetting(input_file, sidecar_file, preview_file)
+    convert_raw_for_vignetting(input_file, sidecar_file, dt_config_root, preview_file)
 
     return True
 
@@ -979,9 +1161,8 @@ def run_vignetting():
         print("Failed to write sidecar_file: %s" % sidecar_file)
         return
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=get_max_worker_count()) as executor:
-        result_futures = []
-
+    with tempfile.TemporaryDirectory(prefix="lenscal_") as dt_config_root:
+        jobs = []
         for path, directories, files in os.walk('vignetting'):
             for filename in files:
                 distance = float("inf")
@@ -1000,16 +1181,21 @@ def run_vignetting():
                     except:
                         continue
 
-                future = executor.submit(create_vignetting_correction, export_path, path, filename, sidecar_file, distance)
-                result_futures.append(future)
+                jobs.append((export_path, path, filename, sidecar_file, dt_config_root, distance))
 
-        for f in concurrent.futures.as_completed(result_futures):
-            if f.result():
+        for result in run_parallel(create_vignetting_correction, jobs):
+            if result:
                 print("OK")
 
     # Create final PDF
     merge_final_pdf("vignetting.pdf", "vignetting/exported")
 
+# Return the items of a dict keyed by numeric strings (focal lengths,
+# apertures, distances) sorted by their value. The key function is only
+# called once per item, so every key is converted to float once.
+def sorted_items(d):
+    return sorted(d.items(), key=lambda item: float(item[0]))
+
 def run_generate_xml():
     print("Generating lensfun.xml")
 
@@ -1023,118 +1209,102 @@ def run_generate_xml():
     lenses = parse_lenses_config('lenses.conf')
 
     # Scan tca files and add to lenses
-    for path, directories, files in os.walk('tca/exported'):
-        for filename in files:
-            if os.path.splitext(filename)[1] != '.tca':
-                continue
+    for tca_file in list_files('tca/exported', '.tca'):
+        config = parse_config_file(tca_file)
 
-            config = configparser.ConfigParser()
-            config.read(os.path.join(path, filename))
+        for lens_model in config:
+            focal_length = config[lens_model]['focal_length']
+            if not focal_length in lenses[lens_model]['tca']:
+                lenses[lens_model]['tca'][focal_length] = {}
 
-            for lens_model in config.sections():
-                focal_length = config[lens_model]['focal_length']
-                if not focal_length in lenses[lens_model]['tca']:
-                    lenses[lens_model]['tca'][focal_length] = {}
-
-                for key in config[lens_model]:
-                    if key != 'focal_length':
-                        lenses[lens_model]['tca'][focal_length][key] = config[lens_model][key]
+            for key in config[lens_model]:
+                if key != 'focal_length':
+                    lenses[lens_model]['tca'][focal_length][key] = config[lens_model][key]
 
     # Scan vig files and add to lenses
-    for path, directories, files in os.walk('vignetting/exported'):
-        for filename in files:
-            if os.path.splitext(filename)[1] != '.vig':
-                continue
+    for vig_file in list_files('vignetting/exported', '.vig'):
+        config = parse_config_file(vig_file)
+
+        for lens_model in config:
+            focal_length = config[lens_model]['focal_length']
+            aperture = config[lens_model]['aperture']
+            distance = config[lens_model]['distance']
+
+            lenses[lens_model]['vignetting'][focal_length][aperture][distance] = {
+                    key: value for key, value in config[lens_model].items()
+                    if key not in ('focal_length', 'aperture', 'distance')
+                    }
+
+    # write lenses to xml, the document is assembled in memory and written
+    # to the file in one go. The names come from EXIF data and lenses.conf, so
+    # they need to be escaped.
+    parts = []
+    w = parts.append
+
+    w('<lensdatabase>\n')
+    for lens_model in lenses:
+        lens = lenses[lens_model]
+
+        w('    <lens>\n')
+        w('        <maker>%s</maker>\n' % escape(lens['maker']))
+        w('        <model>%s</model>\n' % escape(lens_model))
+        w('        <mount>%s</mount>\n' % escape(lens['mount']))
+        w('        <cropfactor>%s</cropfactor>\n' % escape(lens['cropfactor']))
+        if lens['type'] != 'normal':
+            w('        <type>%s</type>\n' % escape(lens['type']))
+
+        # Add calibration data
+        w('        <calibration>\n')
+
+        # Add distortion entries
+        for focal_length, data in sorted_items(lens['distortion']):
+            if data[1] is None:
+                w(LENSFUN_DISTORTION_POLY3_FORMAT % (focal_length, data[0]))
+            else:
+                w(LENSFUN_DISTORTION_PTLENS_FORMAT %
+                  (focal_length, data[0], data[1], data[2]))
+
+        # Add tca entries
+        for focal_length, data in sorted_items(lens['tca']):
+            if data['complex_tca'] == 'True':
+                w(LENSFUN_TCA_COMPLEX_FORMAT %
+                  (focal_length, data['br'], data['vr'], data['bb'], data['vb']))
+            else:
+                w(LENSFUN_TCA_SIMPLE_FORMAT % (focal_length, data['vr'], data['vb']))
+
+        # Add vignetting entries
+        for focal_length, apertures in sorted_items(lens['vignetting']):
+            for aperture, distances in sorted_items(apertures):
+                for distance, data in sorted_items(distances):
+                    if distance == 'inf':
+                        distance = '1000'
+
+                    _distances = [ distance ]
+
+                    # If we only have an infinite distance, we need to write two values
+                    if len(distances) == 1 and distance == '1000':
+                        _distances = [ '10', '1000' ]
+
+                    coefficients = (data['k1'], data['k2'], data['k3'])
+                    for _distance in _distances:
+                        w(LENSFUN_VIGNETTING_FORMAT %
+                          ((focal_length, aperture, _distance) + coefficients))
 
-            config = configparser.ConfigParser()
-            config.read(os.path.join(path, filename))
-
-            for lens_model in config.sections():
-                focal_length = config[lens_model]['focal_length']
-                if not focal_length in lenses[lens_model]['vignetting']:
-                    lenses[lens_model]['vignetting'][focal_length] = {}
-
-                aperture = config[lens_model]['aperture']
-                if not aperture in lenses[lens_model]['vignetting'][focal_length]:
-                    lenses[lens_model]['vignetting'][focal_length][aperture] = {}
-
-                distance = config[lens_model]['distance']
-                if not distance in lenses[lens_model]['vignetting'][focal_length][aperture]:
-                    lenses[lens_model]['vignetting'][focal_length][aperture][distance] = {}
-
-                for key in config[lens_model]:
-                    if key != 'focal_length' and key != 'aperture' and key != 'distance':
-                        lenses[lens_model]['vignetting'][focal_length][aperture][distance][key] = config[lens_model][key]
-
-    # write lenses to xml
-    with open('lensfun.xml', 'w') as f:
-        f.write('<lensdatabase>\n')
-        for lens_model in lenses:
-            f.write('    <lens>\n')
-            f.write('        <maker>%s</maker>\n' % lenses[lens_model]['maker'])
-            f.write('        <model>%s</model>\n' % lens_model)
-            f.write('        <mount>%s</mount>\n' % lenses[lens_model]['mount'])
-            f.write('        <cropfactor>%s</cropfactor>\n' % lenses[lens_model]['cropfactor'])
-            if lenses[lens_model]['type'] != 'normal':
-                f.write('        <type>%s</type>\n' % lenses[lens_model]['type'])
-
-            # Add calibration data
-            f.write('        <calibration>\n')
-
-            # Add distortion entries
-            focal_lengths = lenses[lens_model]['distortion'].keys()
-            for focal_length in sorted(focal_lengths, key=float):
-                data = list(map(str.strip, lenses[lens_model]['distortion'][focal_length].split(',')))
-                if data[1] is None:
-                    f.write('            '
-                            '<distortion model="poly3" focal="%s" k1="%s" />\n' %
-                            (focal_length, data[0]))
-                else:
-                    f.write('            '
-                            '<distortion model="ptlens" focal="%s" a="%s" b="%s" c="%s" />\n' %
-                            (focal_length, data[0], data[1], data[2]))
-
-            # Add tca entries
-            focal_lengths = lenses[lens_model]['tca'].keys()
-            for focal_length in sorted(focal_lengths, key=float):
-                data = lenses[lens_model]['tca'][focal_length]
-                if data['complex_tca'] == 'True':
-                    f.write('            '
-                            '<tca model="poly3" focal="%s" br="%s" vr="%s" bb="%s" vb="%s" />\n' %
-                            (focal_length, data['br'], data['vr'], data['bb'], data['vb']))
-                else:
-                    f.write('            '
-                            '<tca model="poly3" focal="%s" vr="%s" vb="%s" />\n' %
-                            (focal_length, data['vr'], data['vb']))
-
-            # Add vignetting entries
-            focal_lengths = lenses[lens_model]['vignetting'].keys()
-            for focal_length in sorted(focal_lengths, key=float):
-                apertures = lenses[lens_model]['vignetting'][focal_length].keys()
-                for aperture in sorted(apertures, key=float):
-                    distances = lenses[lens_model]['vignetting'][focal_length][aperture].keys()
-                    for distance in sorted(distances, key=float):
-                        data = lenses[lens_model]['vignetting'][focal_length][aperture][distance]
-
-                        if distance == 'inf':
-                            distance = '1000'
-
-                        _distances = [ distance ]
-
-                        # If we only have an infinite distance, we need to write two values
-                        if len(distances) == 1 and distance == '1000':
-                            _distances = [ '10', '1000' ]
-
-                        for _distance in _distances:
-                            f.write('            '
-                                    '<vignetting model="pa" focal="%s" aperture="%s" distance="%s" '
-                                    'k1="%s" k2="%s" k3="%s" />\n' %
-                                    (focal_length, aperture, _distance,
-                                     data['k1'], data['k2'], data['k3']))
-
-            f.write('        </calibration>\n')
-            f.write('    </lens>\n')
-        f.write('</lensdatabase>\n')
+        w('        </calibration>\n')
+        w('    </lens>\n')
+    w('</lensdatabase>\n')
+
+    with open('lensfun.xml', 'w', encoding='utf-8') as f:
+        f.write(''.join(parts))
+
+# Store the files in the tarball as owned by root
+def tarinfo_set_root(tarinfo):
+    tarinfo.uid = 0
+    tarinfo.gid = 0
+    tarinfo.uname = "root"
+    tarinfo.gname = "root"
+
+    return tarinfo
 
 def run_ship():
     if not os.path.exists("lensfun.xml"):
@@ -1142,48 +1312,46 @@ def run_ship():
         return
 
     tar_files = [ "lensfun.xml", "tca.pdf", "vignetting.pdf" ]
+    tar_files.extend(list_files('vignetting/exported', '.jpg'))
     tar_name = "lensfun_calibration.tar.xz"
 
-    vignetting_dir = 'vignetting/exported'
-    if os.path.exists(vignetting_dir):
-        for path, directories, files in os.walk(vignetting_dir):
-            for filename in files:
-                if os.path.splitext(filename)[1] != '.jpg':
-                    continue
-
-                tar_files.append(os.path.join(vignetting_dir, filename))
-
-    tar = tarfile.open(tar_name, 'w:xz')
-
-    for f in tar_files:
-        if not os.path.exists(f):
-            continue
-
-        try:
-            tinfo = tar.gettarinfo(name=f)
+    # The xz tool compresses with all cores, the lzma module of tarfile only
+    # uses a single thread. So if xz is available, write a plain tarball and
+    # compress it afterwards.
+    if XZ is not None:
+        tar_path, tar_mode = os.path.splitext(tar_name)[0], 'w'
+    else:
+        tar_path, tar_mode = tar_name, 'w:xz'
 
-            tinfo.uid = 0
-            tinfo.gid = 0
-            tinfo.uname = "root"
-            tinfo.gname = "root"
-        except OSError:
-            continue
+    with tarfile.open(tar_path, tar_mode) as tar:
+        for f in tar_files:
+            if not os.path.exists(f):
+                continue
 
-        fh = open(f, "rb")
-        tar.addfile(tinfo, fileobj=fh)
-        fh.close()
+            try:
+                tar.add(f, filter=tarinfo_set_root)
+            except OSError:
+                continue
 
-    tar.close()
+    if XZ is not None:
+        subprocess.check_call([XZ, "-T0", "--force", tar_path])
 
     print("Created lensfun_calibration.tar.xz")
     print("Open a bug at https://github.com/lensfun/lensfun/issues/ with the data.")
 
-class CustomDescriptionFormatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawDescriptionHelpFormatter):
-    pass
-
-def main():
-
-    description = '''
+# The actions which can be passed on the command line, each is called with the
+# parsed arguments
+ACTIONS = {
+    'init': lambda args: init(),
+    'distortion': lambda args: run_distortion(),
+    'tca': lambda args: run_tca(args.complex_tca),
+    'vignetting': lambda args: run_vignetting(),
+    'generate_xml': lambda args: run_generate_xml(),
+    'ship': lambda args: run_ship(),
+}
+
+# Overview of the calibration steps shown by --help
+DESCRIPTION = '''
 This is an overview about the calibration steps.\n
 \n
 To setup the required directory structure simply run:
@@ -1258,7 +1426,11 @@ and provide the lensfun_calibratrion.tar.xz
 
 '''
 
-    parser = argparse.ArgumentParser(description=description,
+class CustomDescriptionFormatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawDescriptionHelpFormatter):
+    pass
+
+def main():
+    parser = argparse.ArgumentParser(description=DESCRIPTION,
                                      formatter_class=CustomDescriptionFormatter)
 
     parser.add_argument('--complex-tca',
@@ -1267,29 +1439,19 @@ and provide the lensfun_calibratrion.tar.xz
     #parser.add_argument('-r, --rawconverter', choices=['darktable', 'dcraw'])
 
     parser.add_argument('action',
-                        choices=[
-                            'init',
-                            'distortion',
-                            'tca',
-                            'vignetting',
-                            'generate_xml',
-                            'ship'],
+                        choices=list(ACTIONS),
                         help='This runs one of the actions for lens calibration')
 
     args = parser.parse_args()
 
-    if args.action == 'init':
-        init()
-    elif args.action == 'distortion':
-        run_distortion()
-    elif args.action == 'tca':
-        run_tca(args.complex_tca)
-    elif args.action == 'vignetting':
-        run_vignetting()
-    elif args.action == 'generate_xml':
-        run_generate_xml()
-    elif args.action == 'ship':
-        run_ship()
+    # Check LENSCAL_JOBS once here instead of failing when the first worker
+    # pool is set up
+    try:
+        get_jobs_override()
+    except ValueError as e:
+        parser.error(str(e))
+
+    ACTIONS[args.action](args)
 
 if __name__ == "__main__":
     main()